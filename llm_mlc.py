@@ -1,12 +1,19 @@
 import click
+from concurrent.futures import ThreadPoolExecutor
 import contextlib
+import functools
+import hashlib
 import json
 import llm
+import logging
 import os
+import pathlib
 from pydantic import Field
+import socket
+import socketserver
 import subprocess
 import sys
-import textwrap
+import threading
 from typing import Optional
 
 
@@ -16,12 +23,22 @@ MODEL_URLS = {
     "Llama-2-70b-chat": "https://huggingface.co/mlc-ai/mlc-chat-Llama-2-70b-chat-hf-q4f16_1",
 }
 
+DOWNLOAD_MODEL_HELP = (
+    "Download and register one or more models from a name or URL\n\n"
+    "Try one of these names:\n\n"
+    "\b\n" + "\n".join("- {}".format(key) for key in MODEL_URLS)
+)
+
+# Only the native libraries are needed, not the much larger WebGPU builds
+LIB_LFS_INCLUDE = "*.so,*.dylib,*.dll"
+
 MLC_INSTALL = (
     "You must install mlc_chat first. "
     "See https://github.com/simonw/llm-mlc for instructions."
 )
 
 
+@functools.lru_cache(maxsize=None)
 def is_git_lfs_command_available():
     try:
         subprocess.run(
@@ -35,7 +52,16 @@ def is_git_lfs_command_available():
         return False
 
 
+@functools.lru_cache(maxsize=None)
 def is_git_lfs_installed():
+    # 'git lfs install' writes a [filter "lfs"] section to ~/.gitconfig, so
+    # check for that first to avoid running git at all
+    try:
+        gitconfig = pathlib.Path("~/.gitconfig").expanduser().read_text()
+        if '[filter "lfs"]' in gitconfig:
+            return True
+    except OSError:
+        pass
     try:
         # Run the git config command to get the filter value
         result = subprocess.check_output(
@@ -52,19 +78,70 @@ def is_git_lfs_installed():
         return False
 
 
-def _ensure_models_dir():
-    directory = llm.user_dir() / "llama-cpp" / "models"
-    directory.mkdir(parents=True, exist_ok=True)
-    return directory
+def shallow_clone_command(url, path):
+    # Only the latest revision is needed, so skip fetching the full history
+    return [
+        "git",
+        "clone",
+        "--progress",
+        "--depth=1",
+        "--single-branch",
+        url,
+        str(path),
+    ]
+
+
+def run_with_progress(command, label):
+    """
+    Run a command, echoing each line of its stderr prefixed with label so the
+    progress of several commands running at once can be told apart
+    """
+    process = subprocess.Popen(
+        command,
+        stdout=subprocess.DEVNULL,
+        stderr=subprocess.PIPE,
+        text=True,
+        bufsize=1,
+    )
+    try:
+        # Universal newlines split git's \r-separated progress updates into lines
+        for line in process.stderr:
+            line = line.rstrip()
+            if line:
+                click.echo("{}: {}".format(label, line), err=True)
+    except BaseException:
+        # e.g. Ctrl+C - don't leave the command running in the background
+        process.kill()
+        process.wait()
+        raise
+    returncode = process.wait()
+    if returncode:
+        raise subprocess.CalledProcessError(returncode, command)
+
+
+def git_origin_url(path):
+    "Returns the origin URL of the git checkout at path, or None if it is not one"
+    # Only look at path itself, not any repository that encloses it
+    if not (pathlib.Path(path) / ".git").exists():
+        return None
+    try:
+        return subprocess.check_output(
+            ["git", "-C", str(path), "config", "--get", "remote.origin.url"],
+            encoding="utf-8",
+        ).strip()
+    except subprocess.CalledProcessError:
+        return None
 
 
-def _ensure_models_file():
-    directory = llm.user_dir() / "llama-cpp"
-    directory.mkdir(parents=True, exist_ok=True)
-    filepath = directory / "models.json"
-    if not filepath.exists():
-        filepath.write_text("{}")
-    return filepath
+def repo_cache_dir(url):
+    # Cloned repositories are shared between installs, keyed on their URL
+    cache_root = os.environ.get("XDG_CACHE_HOME") or "~/.cache"
+    return (
+        pathlib.Path(cache_root).expanduser()
+        / "llm-mlc"
+        / "repos"
+        / hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
+    )
 
 
 @llm.hookimpl
@@ -73,15 +150,18 @@ def register_models(register):
     models_dir = directory / "dist" / "prebuilt"
     if not models_dir.exists():
         return
-    for child in models_dir.iterdir():
-        if child.is_dir() and child.name != "lib":
-            # It's a model! Register it
-            register(
-                MlcModel(
-                    model_id=child.name,
-                    model_path=str(child.absolute()),
+    # os.scandir() reuses the file type from the directory listing, avoiding
+    # a stat() call per entry - this runs on every llm invocation
+    with os.scandir(models_dir.absolute()) as entries:
+        for entry in entries:
+            if entry.is_dir() and entry.name != "lib":
+                # It's a model! Register it
+                register(
+                    MlcModel(
+                        model_id=entry.name,
+                        model_path=entry.path,
+                    )
                 )
-            )
 
 
 @llm.hookimpl
@@ -115,65 +195,126 @@ def register_commands(cli):
             click.echo("Downloading prebuilt binaries...")
             # mkdir -p dist/prebuilt
             (dist_dir / "prebuilt").mkdir(parents=True, exist_ok=True)
-            # git clone
-            git_clone_command = [
-                "git",
-                "clone",
-                "https://github.com/mlc-ai/binary-mlc-llm-libs.git",
-                str((dist_dir / "prebuilt" / "lib").absolute()),
-            ]
-            subprocess.run(git_clone_command, check=True)
+            # git clone, skipping LFS files so we can fetch just native libraries
+            lib_dir = (dist_dir / "prebuilt" / "lib").absolute()
+            git_clone_command = shallow_clone_command(
+                "https://github.com/mlc-ai/binary-mlc-llm-libs.git", lib_dir
+            )
+            subprocess.run(
+                git_clone_command,
+                check=True,
+                env=dict(os.environ, GIT_LFS_SKIP_SMUDGE="1"),
+            )
+            subprocess.run(
+                ["git", "lfs", "pull", "--include", LIB_LFS_INCLUDE],
+                cwd=str(lib_dir),
+                check=True,
+            )
         click.echo("Ready to install models in {}".format(directory))
         # Do we have mlc_chat installed?
-        try:
-            import mlc_chat
-        except ImportError:
-            raise click.ClickException(MLC_INSTALL)
+        load_mlc_chat()
 
-    @mlc.command(
-        help=textwrap.dedent(
-            """
-        Download and register a model from a URL
-
-        Try one of these names:
-        
-        \b
-        {}
-        """
-        ).format("\n".join("- {}".format(key) for key in MODEL_URLS.keys()))
-    )
-    @click.argument("name_or_url")
+    @mlc.command(help=DOWNLOAD_MODEL_HELP)
+    @click.argument("names_or_urls", nargs=-1, required=True)
     @click.option(
         "aliases", "-a", "--alias", multiple=True, help="Alias to use for this model"
     )
-    def download_model(name_or_url, aliases):
-        url = MODEL_URLS.get(name_or_url) or name_or_url
-        if name_or_url in MODEL_URLS:
-            # Set that up as an alias too
-            aliases = list(aliases) + [name_or_url]
-        if not url.startswith("https://"):
-            raise click.BadParameter("Invalid model name or URL")
+    def download_model(names_or_urls, aliases):
+        if aliases and len(names_or_urls) > 1:
+            raise click.UsageError(
+                "--alias can only be used when downloading a single model"
+            )
+        urls = []
+        # Maps each alias to the model ID it should point to
+        alias_model_ids = {}
+        for name_or_url in names_or_urls:
+            url = MODEL_URLS.get(name_or_url) or name_or_url
+            if not url.startswith("https://"):
+                raise click.BadParameter("Invalid model name or URL")
+            last_bit = url.split("/")[-1]
+            for alias in aliases:
+                alias_model_ids[alias] = last_bit
+            if name_or_url in MODEL_URLS:
+                # Set that up as an alias too
+                alias_model_ids[name_or_url] = last_bit
+            if url not in urls:
+                urls.append(url)
         directory = llm.user_dir() / "mlc"
         prebuilt_dir = directory / "dist" / "prebuilt"
         if not prebuilt_dir.exists():
             raise click.ClickException("You must run 'llm mlc setup' first")
-        # Run git clone URL dist/prebuilt
-        last_bit = url.split("/")[-1]
-        git_clone_command = [
-            "git",
-            "clone",
-            url,
-            str((prebuilt_dir / last_bit).absolute()),
-        ]
-        subprocess.run(git_clone_command, check=True)
-        if aliases:
+
+        def clone(url):
+            # Link dist/prebuilt to a clone in the shared cache, working out
+            # where the checkout lives before downloading anything
+            last_bit = url.split("/")[-1]
+            cache_dir = repo_cache_dir(url)
+            model_dir = prebuilt_dir / last_bit
+            if not os.path.lexists(model_dir):
+                try:
+                    model_dir.symlink_to(cache_dir, target_is_directory=True)
+                    checkout_dir = cache_dir
+                except OSError:
+                    # Symlinks are not available, e.g. Windows without
+                    # developer mode, so clone straight into dist/prebuilt
+                    checkout_dir = model_dir
+            elif model_dir.is_symlink():
+                if os.path.realpath(model_dir) != os.path.realpath(cache_dir):
+                    raise click.ClickException(
+                        "{} already exists and links to a different "
+                        "repository".format(model_dir)
+                    )
+                checkout_dir = cache_dir
+            else:
+                # Installed before the shared cache existed - update in place
+                checkout_dir = model_dir
+            if checkout_dir.exists():
+                # Never run git in a directory that is not a checkout of this
+                # URL - git would act on any repository that encloses it
+                if git_origin_url(checkout_dir) != url:
+                    raise click.ClickException(
+                        "{} already exists and is not a checkout of {}".format(
+                            model_dir, url
+                        )
+                    )
+                # A plain fetch extends a shallow clone with just the new
+                # commits, so the fast-forward below can connect to them
+                run_with_progress(
+                    ["git", "-C", str(checkout_dir), "fetch", "--progress", "origin"],
+                    last_bit,
+                )
+                # Refuse rather than discard any local changes to the checkout
+                run_with_progress(
+                    [
+                        "git",
+                        "-C",
+                        str(checkout_dir),
+                        "merge",
+                        "--ff-only",
+                        "FETCH_HEAD",
+                    ],
+                    last_bit,
+                )
+            else:
+                checkout_dir.parent.mkdir(parents=True, exist_ok=True)
+                run_with_progress(shallow_clone_command(url, checkout_dir), last_bit)
+
+        # Each clone is network-bound, so run them in parallel
+        with ThreadPoolExecutor(max_workers=min(4, len(urls))) as executor:
+            list(executor.map(clone, urls))
+        if alias_model_ids:
             aliases_path = llm.user_dir() / "aliases.json"
-            if not aliases_path.exists():
-                aliases_path.write_text("{}")
-            aliases_data = json.loads(aliases_path.read_text())
-            for alias in aliases:
-                aliases_data[alias] = last_bit
-            aliases_path.write_text(json.dumps(aliases_data, indent=2))
+            aliases_data = {}
+            if aliases_path.exists():
+                with open(aliases_path) as fp:
+                    aliases_data = json.load(fp)
+            new_aliases_data = dict(aliases_data, **alias_model_ids)
+            if new_aliases_data != aliases_data:
+                # Write to a temporary file first so a crash can't corrupt it
+                tmp_path = aliases_path.with_suffix(".json.tmp")
+                with open(tmp_path, "w") as fp:
+                    json.dump(new_aliases_data, fp, indent=2)
+                os.replace(tmp_path, aliases_path)
 
     @mlc.command()
     def models():
@@ -197,6 +338,56 @@ def register_commands(cli):
         directory = llm.user_dir() / "mlc" / "dist" / "prebuilt"
         click.echo(directory.absolute())
 
+    @mlc.command()
+    @click.argument("model_ids", nargs=-1)
+    def serve(model_ids):
+        """
+        Run a server that keeps models loaded between prompts
+
+        Prompts to MLC models will be sent to this server while it is running,
+        avoiding the cost of loading the model for every prompt. Models are
+        loaded on first use, or pass model IDs or aliases to load them up front.
+        """
+        if not hasattr(socket, "AF_UNIX"):
+            raise click.ClickException(
+                "llm mlc serve needs Unix domain sockets, which are not "
+                "available on this platform"
+            )
+        models = {}
+        for model_id in model_ids:
+            try:
+                model = llm.get_model(model_id)
+            except llm.UnknownModelError as ex:
+                raise click.ClickException(str(ex))
+            if not isinstance(model, MlcModel):
+                raise click.ClickException("{} is not an MLC model".format(model_id))
+            click.echo("Loading {}".format(model.model_id))
+            model.load_chat_mod()
+            models[model.model_path] = model
+
+        path = server_socket_path()
+        if path.exists():
+            try:
+                with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as sock:
+                    sock.connect(str(path))
+            except OSError:
+                # Left behind by a server that did not shut down cleanly
+                path.unlink()
+            else:
+                raise click.ClickException("A server is already running")
+
+        # Requests are handled one at a time, since a model can only run
+        # one generation at once
+        with socketserver.UnixStreamServer(str(path), ServeHandler) as server:
+            server.models = models
+            click.echo("Serving on {}".format(path))
+            try:
+                server.serve_forever()
+            except KeyboardInterrupt:
+                pass
+            finally:
+                path.unlink()
+
     @mlc.command(
         context_settings={
             "ignore_unknown_options": True,
@@ -250,20 +441,38 @@ class MlcModel(llm.Model):
         self.model_id = model_id
         self.model_path = model_path
         self.chat_mod = None  # Lazy loading
+        self.chat_state = None
+        self.chat_config_state = None
 
     def execute(self, prompt, stream, response, conversation):
-        try:
-            import mlc_chat
-            from mlc_chat.base import get_delta_message
-            import mlc_chat.chat_module
-        except ImportError:
-            raise click.ClickException(MLC_INSTALL)
-
-        # Disable print() in that module
-        def noop(*args, **kwargs):
-            pass
+        system_prompt = None
+        messages = []
+        if conversation:
+            messages, system_prompt = conversation_messages(conversation)
+        if prompt.system:
+            system_prompt = prompt.system
+
+        # Use the model already loaded by 'llm mlc serve' if it is running
+        deltas = send_to_server(
+            {
+                "model_path": self.model_path,
+                "prompt": prompt.prompt,
+                "system": system_prompt,
+                "messages": messages,
+                "options": dict(prompt.options),
+                "stream": stream,
+            }
+        )
+        if deltas is None:
+            deltas = self.generate(
+                prompt.prompt, system_prompt, messages, prompt.options, stream
+            )
+        yield from deltas
 
-        mlc_chat.chat_module.__dict__["print"] = noop
+    def load_chat_mod(self):
+        if self.chat_mod is not None:
+            return self.chat_mod
+        mlc_chat, get_delta_message = load_mlc_chat()
 
         class StreamingChatModule(mlc_chat.ChatModule):
             def generate_iter(self, prompt):
@@ -272,71 +481,247 @@ class MlcModel(llm.Model):
                 while not self._stopped():
                     self._decode()
                     new_msg = self._get_message()
-                    delta = get_delta_message(curr_message, new_msg)
+                    if new_msg.startswith(curr_message):
+                        # Usual case: the message has been extended
+                        delta = new_msg[len(curr_message) :]
+                    else:
+                        # Earlier text changed, e.g. a partial multi-byte
+                        # character was completed
+                        delta = get_delta_message(curr_message, new_msg)
                     curr_message = new_msg
                     yield delta
 
         with SuppressOutput():
-            config_kwargs = {}
-
-            system_prompt = None
-            if conversation:
-                messages = []
-                # Populate messages from the conversation history
-                for prev_response in conversation.responses:
-                    if prev_response.prompt.system:
-                        # Use the last set system prompt in that sequence
-                        system_prompt = prev_response.prompt.system
-                    messages.extend(
-                        [
-                            ["USER", prev_response.prompt.prompt],
-                            ["ASSISTANT", prev_response.text()],
-                        ]
+            # mlc_chat looks for model libraries in dist/prebuilt/lib relative
+            # to the current directory
+            with temp_chdir(llm.user_dir() / "mlc"):
+                self.chat_mod = StreamingChatModule(model=self.model_path)
+        return self.chat_mod
+
+    def generate(self, prompt, system_prompt, messages, options, stream):
+        mlc_chat, _ = load_mlc_chat()
+        chat_mod = self.load_chat_mod()
+
+        options_key = (
+            options.max_gen_len,
+            options.temperature,
+            options.top_p,
+            options.repetition_penalty,
+        )
+        history = [list(message) for message in messages]
+        # The system prompt, options and conversation so far held by chat_mod
+        chat_state = (system_prompt, options_key, history)
+
+        with SuppressOutput():
+            # If this prompt continues the conversation chat_mod already holds
+            # there is no need to reset it and process the history again
+            if chat_state != self.chat_state:
+                if chat_state == self.chat_config_state:
+                    # Same config as the last reset, so chat_mod can reset to
+                    # that without building and loading a new ChatConfig
+                    chat_mod.reset_chat()
+                else:
+                    chat_mod.reset_chat(
+                        self.build_chat_config(
+                            mlc_chat, system_prompt, messages, options
+                        )
                     )
-                if messages:
-                    config_kwargs["messages"] = messages
-                    config_kwargs["offset"] = len(messages)
+                    self.chat_config_state = chat_state
 
-            if self.chat_mod is None:
-                with temp_chdir(llm.user_dir() / "mlc"):
-                    self.chat_mod = StreamingChatModule(model=self.model_path)
+            # Unknown until the whole response has been generated
+            self.chat_state = None
+            if stream:
+                deltas = []
+                for delta in chat_mod.generate_iter(prompt=prompt):
+                    deltas.append(delta)
+                    yield delta
+                text = "".join(deltas)
+            else:
+                # All in one go
+                text = chat_mod.generate(prompt=prompt)
+                yield text
+            self.chat_state = (
+                system_prompt,
+                options_key,
+                history + [["USER", prompt], ["ASSISTANT", text]],
+            )
 
-            if prompt.system:
-                system_prompt = prompt.system
+    def build_chat_config(self, mlc_chat, system_prompt, messages, options):
+        config_kwargs = {}
+        if messages:
+            config_kwargs["messages"] = messages
+            config_kwargs["offset"] = len(messages)
 
-            if system_prompt is not None:
-                config_kwargs["system"] = system_prompt
+        if system_prompt is not None:
+            config_kwargs["system"] = system_prompt
 
-            chat_config_kwargs = {
-                "max_gen_len": prompt.options.max_gen_len or 512,
-                "conv_config": mlc_chat.ConvConfig(**config_kwargs),
-            }
-            if prompt.options.temperature is not None:
-                chat_config_kwargs["temperature"] = prompt.options.temperature
-            if prompt.options.top_p is not None:
-                chat_config_kwargs["top_p"] = prompt.options.top_p
-            if prompt.options.repetition_penalty is not None:
-                chat_config_kwargs[
-                    "repetition_penalty"
-                ] = prompt.options.repetition_penalty
+        chat_config_kwargs = {
+            "max_gen_len": options.max_gen_len or 512,
+            "conv_config": mlc_chat.ConvConfig(**config_kwargs),
+        }
+        if options.temperature is not None:
+            chat_config_kwargs["temperature"] = options.temperature
+        if options.top_p is not None:
+            chat_config_kwargs["top_p"] = options.top_p
+        if options.repetition_penalty is not None:
+            chat_config_kwargs["repetition_penalty"] = options.repetition_penalty
+        return mlc_chat.ChatConfig(**chat_config_kwargs)
+
+
+def conversation_messages(conversation):
+    """
+    Returns the messages and most recent system prompt for a conversation,
+    caching them on the conversation so each turn only processes new responses
+    """
+    responses = conversation.responses
+    count, messages, system_prompt = getattr(
+        conversation, "_mlc_messages", (0, [], None)
+    )
+    if count > len(responses):
+        count, messages, system_prompt = 0, [], None
+    new_responses = responses[count:]
+    # Use the last set system prompt in that sequence
+    system_prompt = next(
+        (r.prompt.system for r in reversed(new_responses) if r.prompt.system),
+        system_prompt,
+    )
+    # Populate messages from the conversation history
+    messages.extend(
+        message
+        for prev_response in new_responses
+        for message in (
+            ("USER", prev_response.prompt.prompt),
+            ("ASSISTANT", prev_response.text()),
+        )
+    )
+    conversation._mlc_messages = (len(responses), messages, system_prompt)
+    return messages, system_prompt
 
-            self.chat_mod.reset_chat(mlc_chat.ChatConfig(**chat_config_kwargs))
 
-            if stream:
-                yield from self.chat_mod.generate_iter(prompt=prompt.prompt)
-            else:
-                # All in one go
-                yield self.chat_mod.generate(prompt=prompt.prompt)
+# None until the first import attempt, then False if mlc_chat is missing
+_mlc_chat = None
+
+
+def load_mlc_chat():
+    """
+    Import mlc_chat on first use, returning (mlc_chat, get_delta_message) -
+    raises a ClickException if it is not installed
+    """
+    global _mlc_chat
+    if _mlc_chat is None:
+        try:
+            import mlc_chat
+            from mlc_chat.base import get_delta_message
+            import mlc_chat.chat_module
+        except ImportError:
+            _mlc_chat = False
+        else:
+            silence_mlc_chat(mlc_chat)
+            _mlc_chat = (mlc_chat, get_delta_message)
+    if not _mlc_chat:
+        raise click.ClickException(MLC_INSTALL)
+    return _mlc_chat
+
+
+def silence_mlc_chat(mlc_chat):
+    # Disable print() in that module
+    def noop(*args, **kwargs):
+        pass
+
+    mlc_chat.chat_module.__dict__["print"] = noop
+
+    # Silence anything mlc_chat reports through logging too
+    logger = logging.getLogger("mlc_chat")
+    logger.addHandler(logging.NullHandler())
+    logger.propagate = False
+
+
+class ServeHandler(socketserver.StreamRequestHandler):
+    "Handles a single prompt sent to 'llm mlc serve' by send_to_server()"
+
+    def handle(self):
+        line = self.rfile.readline()
+        if not line:
+            # Connections with no request check if a server is running
+            return
+        request = json.loads(line)
+        # Maps model paths to MlcModel instances with loaded chat modules
+        models = self.server.models
+        model_path = request["model_path"]
+        if model_path not in models:
+            models[model_path] = MlcModel(
+                model_id=os.path.basename(model_path), model_path=model_path
+            )
+        try:
+            for delta in models[model_path].generate(
+                request["prompt"],
+                request["system"],
+                request["messages"],
+                MlcModel.Options(**request["options"]),
+                request["stream"],
+            ):
+                self.send({"delta": delta})
+        except BrokenPipeError:
+            # The client has gone away
+            pass
+        except Exception as ex:
+            self.send({"error": str(ex)})
+
+    def send(self, message):
+        self.wfile.write((json.dumps(message) + "\n").encode("utf-8"))
+
+
+def server_socket_path():
+    return llm.user_dir() / "mlc" / "serve.sock"
+
+
+def send_to_server(request):
+    """
+    Send a prompt to a running 'llm mlc serve' process, returning an iterator
+    of response deltas - or None if the server is not running
+    """
+    path = server_socket_path()
+    if not hasattr(socket, "AF_UNIX") or not path.exists():
+        return None
+    sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+    try:
+        sock.connect(str(path))
+    except OSError:
+        # Probably a stale socket left behind by a server that has exited
+        sock.close()
+        return None
+    sock.sendall((json.dumps(request) + "\n").encode("utf-8"))
+    return read_deltas(sock)
+
+
+def read_deltas(sock):
+    with sock, sock.makefile("r", encoding="utf-8") as fp:
+        for line in fp:
+            message = json.loads(line)
+            if "error" in message:
+                raise click.ClickException(message["error"])
+            yield message["delta"]
+
+
+# The working directory is process-wide, so only one thread may change it
+_chdir_lock = threading.Lock()
 
 
 @contextlib.contextmanager
 def temp_chdir(path):
-    old_dir = os.getcwd()
-    os.chdir(path)
-    try:
-        yield
-    finally:
-        os.chdir(old_dir)
+    with _chdir_lock:
+        old_dir = os.getcwd()
+        os.chdir(path)
+        try:
+            yield
+        finally:
+            os.chdir(old_dir)
+
+
+@functools.lru_cache(maxsize=None)
+def _devnull_fd():
+    # Opened once and reused by every SuppressOutput block
+    return os.open(os.devnull, os.O_WRONLY)
 
 
 class SuppressOutput:
@@ -345,20 +730,22 @@ class SuppressOutput:
         self.stdout_fd = os.dup(1)
         self.stderr_fd = os.dup(2)
 
-        # Open a file to /dev/null
-        self.devnull_fd = os.open(os.devnull, os.O_WRONLY)
-
         # Replace stdout and stderr with /dev/null
-        os.dup2(self.devnull_fd, 1)
-        os.dup2(self.devnull_fd, 2)
+        os.dup2(_devnull_fd(), 1)
+        os.dup2(_devnull_fd(), 2)
 
-        # Writes to sys.stdout and sys.stderr should still work
+        # Writes to sys.stdout and sys.stderr should still work - these are
+        # needed because llm prints the streamed response inside this block
         self.original_stdout = sys.stdout
         self.original_stderr = sys.stderr
-        sys.stdout = os.fdopen(self.stdout_fd, "w")
-        sys.stderr = os.fdopen(self.stderr_fd, "w")
+        sys.stdout = os.fdopen(self.stdout_fd, "w", closefd=False)
+        sys.stderr = os.fdopen(self.stderr_fd, "w", closefd=False)
 
     def __exit__(self, exc_type, exc_val, exc_tb):
+        # Flush anything written via sys.stdout and sys.stderr in the block
+        sys.stdout.flush()
+        sys.stderr.flush()
+
         # Restore stdout and stderr to their original state
         os.dup2(self.stdout_fd, 1)
         os.dup2(self.stderr_fd, 2)
@@ -367,9 +754,6 @@ class SuppressOutput:
         os.close(self.stdout_fd)
         os.close(self.stderr_fd)
 
-        # Close the file descriptor for /dev/null
-        os.close(self.devnull_fd)
-
         # Restore sys.stdout and sys.stderr
         sys.stdout = self.original_stdout
         sys.stderr = self.original_stderr
@@ -1,6 +1,480 @@
+import click
+from click.testing import CliRunner
+import hashlib
+import json
+import llm_mlc
+from llm.cli import cli
 from llm.plugins import pm
+from llm_mlc import (
+    MlcModel,
+    conversation_messages,
+    repo_cache_dir,
+    send_to_server,
+    server_socket_path,
+)
+import os
+import pathlib
+import pytest
+import socket
+import subprocess
+import sys
+import threading
+import types
 
 
 def test_plugin_is_installed():
     plugins = pm.get_plugins()
     assert "llm_mlc" in {mod.__name__ for mod in plugins}
+
+
+def test_download_model_help():
+    runner = CliRunner()
+    result = runner.invoke(cli, ["mlc", "download-model", "--help"])
+    assert result.exit_code == 0
+    assert (
+        "  Try one of these names:\n\n"
+        "  - Llama-2-7b-chat\n"
+        "  - Llama-2-13b-chat\n"
+        "  - Llama-2-70b-chat\n"
+    ) in result.output
+
+
+@pytest.fixture
+def user_path(tmp_path, monkeypatch):
+    monkeypatch.setenv("LLM_USER_PATH", str(tmp_path))
+    monkeypatch.setenv("XDG_CACHE_HOME", str(tmp_path / "cache"))
+    (tmp_path / "mlc" / "dist" / "prebuilt").mkdir(parents=True)
+    return tmp_path
+
+
+@pytest.fixture
+def mock_run(monkeypatch):
+    commands = []
+
+    class FakePopen:
+        def __init__(self, command, **kwargs):
+            commands.append(command)
+            self.stderr = ["Cloning...\n", "Receiving objects: 100%\n"]
+
+        def wait(self):
+            return 0
+
+    monkeypatch.setattr(
+        subprocess, "run", lambda command, **kwargs: commands.append(command)
+    )
+    monkeypatch.setattr(subprocess, "Popen", FakePopen)
+    return commands
+
+
+@pytest.fixture
+def mock_origins(monkeypatch):
+    # Maps checkout paths to their remote.origin.url
+    origins = {}
+
+    def check_output(command, **kwargs):
+        path = command[2]
+        if command[3:] != ["config", "--get", "remote.origin.url"]:
+            raise AssertionError("Unexpected command: {}".format(command))
+        if path not in origins:
+            raise subprocess.CalledProcessError(1, command)
+        return origins[path] + "\n"
+
+    monkeypatch.setattr(subprocess, "check_output", check_output)
+    return origins
+
+
+def make_checkout(path, url, origins):
+    (path / ".git").mkdir(parents=True)
+    origins[str(path)] = url
+
+
+def test_download_model_multiple(user_path, mock_run):
+    runner = CliRunner()
+    result = runner.invoke(
+        cli, ["mlc", "download-model", "Llama-2-7b-chat", "Llama-2-13b-chat"]
+    )
+    assert result.exit_code == 0, result.output
+    prebuilt = user_path / "mlc" / "dist" / "prebuilt"
+    repos = user_path / "cache" / "llm-mlc" / "repos"
+    expected = []
+    for size in ("7b", "13b"):
+        url = (
+            "https://huggingface.co/mlc-ai/mlc-chat-Llama-2-{}-chat-hf-q4f16_1".format(
+                size
+            )
+        )
+        cache_dir = repos / hashlib.sha1(url.encode("utf-8")).hexdigest()[:16]
+        expected.append(
+            [
+                "git",
+                "clone",
+                "--progress",
+                "--depth=1",
+                "--single-branch",
+                url,
+                str(cache_dir),
+            ]
+        )
+        model_dir = prebuilt / url.split("/")[-1]
+        assert model_dir.is_symlink()
+        assert os.readlink(model_dir) == str(cache_dir)
+    assert sorted(mock_run) == sorted(expected)
+    assert json.loads((user_path / "aliases.json").read_text()) == {
+        "Llama-2-7b-chat": "mlc-chat-Llama-2-7b-chat-hf-q4f16_1",
+        "Llama-2-13b-chat": "mlc-chat-Llama-2-13b-chat-hf-q4f16_1",
+    }
+
+
+def test_download_model_preserves_existing_aliases(user_path, mock_run):
+    aliases_path = user_path / "aliases.json"
+    aliases_path.write_text(json.dumps({"other": "other-model"}))
+    runner = CliRunner()
+    result = runner.invoke(
+        cli, ["mlc", "download-model", "Llama-2-7b-chat", "-a", "llama2"]
+    )
+    assert result.exit_code == 0, result.output
+    assert json.loads(aliases_path.read_text()) == {
+        "other": "other-model",
+        "llama2": "mlc-chat-Llama-2-7b-chat-hf-q4f16_1",
+        "Llama-2-7b-chat": "mlc-chat-Llama-2-7b-chat-hf-q4f16_1",
+    }
+    assert not (user_path / "aliases.json.tmp").exists()
+
+
+def test_download_model_alias_requires_single_model(user_path, mock_run):
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        ["mlc", "download-model", "Llama-2-7b-chat", "Llama-2-13b-chat", "-a", "l"],
+    )
+    assert result.exit_code == 2
+    assert "--alias can only be used when downloading a single model" in result.output
+    assert mock_run == []
+
+
+def test_download_model_updates_cached_repo(user_path, mock_run, mock_origins):
+    url = "https://huggingface.co/mlc-ai/mlc-chat-Llama-2-7b-chat-hf-q4f16_1"
+    cache_dir = repo_cache_dir(url)
+    make_checkout(cache_dir, url, mock_origins)
+    prebuilt = user_path / "mlc" / "dist" / "prebuilt"
+    (prebuilt / url.split("/")[-1]).symlink_to(cache_dir)
+    runner = CliRunner()
+    result = runner.invoke(cli, ["mlc", "download-model", url])
+    assert result.exit_code == 0, result.output
+    assert (
+        "mlc-chat-Llama-2-7b-chat-hf-q4f16_1: Receiving objects: 100%" in result.output
+    )
+    assert mock_run == [
+        ["git", "-C", str(cache_dir), "fetch", "--progress", "origin"],
+        ["git", "-C", str(cache_dir), "merge", "--ff-only", "FETCH_HEAD"],
+    ]
+
+
+def test_run_with_progress_kills_process_on_interrupt(monkeypatch):
+    calls = []
+
+    def interrupted_stderr():
+        yield "Cloning...\n"
+        raise KeyboardInterrupt
+
+    class FakePopen:
+        def __init__(self, command, **kwargs):
+            self.stderr = interrupted_stderr()
+
+        def kill(self):
+            calls.append("kill")
+
+        def wait(self):
+            calls.append("wait")
+            return -9
+
+    monkeypatch.setattr(subprocess, "Popen", FakePopen)
+    with pytest.raises(KeyboardInterrupt):
+        llm_mlc.run_with_progress(["git", "clone", "url", "path"], "model")
+    assert calls == ["kill", "wait"]
+
+
+def test_download_model_updates_existing_checkout(user_path, mock_run, mock_origins):
+    # Models installed before the shared cache existed are updated in place
+    url = "https://huggingface.co/mlc-ai/mlc-chat-Llama-2-7b-chat-hf-q4f16_1"
+    model_dir = user_path / "mlc" / "dist" / "prebuilt" / url.split("/")[-1]
+    make_checkout(model_dir, url, mock_origins)
+    runner = CliRunner()
+    result = runner.invoke(cli, ["mlc", "download-model", "Llama-2-7b-chat"])
+    assert result.exit_code == 0, result.output
+    assert mock_run == [
+        ["git", "-C", str(model_dir), "fetch", "--progress", "origin"],
+        ["git", "-C", str(model_dir), "merge", "--ff-only", "FETCH_HEAD"],
+    ]
+    assert not model_dir.is_symlink()
+    assert not repo_cache_dir(url).exists()
+    assert json.loads((user_path / "aliases.json").read_text()) == {
+        "Llama-2-7b-chat": "mlc-chat-Llama-2-7b-chat-hf-q4f16_1",
+    }
+
+
+def test_download_model_refuses_non_git_directory(user_path, mock_run, mock_origins):
+    # git would otherwise act on any repository enclosing the directory
+    model_dir = user_path / "mlc" / "dist" / "prebuilt" / "model-x"
+    model_dir.mkdir()
+    runner = CliRunner()
+    result = runner.invoke(
+        cli, ["mlc", "download-model", "https://huggingface.co/orgA/model-x"]
+    )
+    assert result.exit_code == 1
+    assert (
+        "{} already exists and is not a checkout of "
+        "https://huggingface.co/orgA/model-x".format(model_dir)
+    ) in result.output
+    assert mock_run == []
+    assert not (user_path / "aliases.json").exists()
+
+
+def test_download_model_refuses_checkout_of_other_url(
+    user_path, mock_run, mock_origins
+):
+    model_dir = user_path / "mlc" / "dist" / "prebuilt" / "model-x"
+    make_checkout(model_dir, "https://huggingface.co/orgA/model-x", mock_origins)
+    runner = CliRunner()
+    result = runner.invoke(
+        cli, ["mlc", "download-model", "https://huggingface.co/orgB/model-x"]
+    )
+    assert result.exit_code == 1
+    assert "is not a checkout of https://huggingface.co/orgB/model-x" in result.output
+    assert mock_run == []
+
+
+def test_download_model_refuses_symlink_to_other_url(user_path, mock_run, mock_origins):
+    url_a = "https://huggingface.co/orgA/model-x"
+    make_checkout(repo_cache_dir(url_a), url_a, mock_origins)
+    model_dir = user_path / "mlc" / "dist" / "prebuilt" / "model-x"
+    model_dir.symlink_to(repo_cache_dir(url_a), target_is_directory=True)
+    runner = CliRunner()
+    result = runner.invoke(
+        cli,
+        ["mlc", "download-model", "https://huggingface.co/orgB/model-x", "-a", "bx"],
+    )
+    assert result.exit_code == 1
+    assert (
+        "{} already exists and links to a different repository".format(model_dir)
+        in result.output
+    )
+    assert mock_run == []
+    assert not (user_path / "aliases.json").exists()
+
+
+def test_download_model_without_symlinks(user_path, mock_run, monkeypatch):
+    def symlink_to(*args, **kwargs):
+        raise OSError("symbolic link privilege not held")
+
+    monkeypatch.setattr(pathlib.Path, "symlink_to", symlink_to)
+    url = "https://huggingface.co/mlc-ai/mlc-chat-Llama-2-7b-chat-hf-q4f16_1"
+    model_dir = user_path / "mlc" / "dist" / "prebuilt" / url.split("/")[-1]
+    runner = CliRunner()
+    result = runner.invoke(cli, ["mlc", "download-model", url])
+    assert result.exit_code == 0, result.output
+    assert mock_run == [
+        [
+            "git",
+            "clone",
+            "--progress",
+            "--depth=1",
+            "--single-branch",
+            url,
+            str(model_dir),
+        ]
+    ]
+
+
+def test_register_models_follows_symlinks(user_path):
+    cache_dir = user_path / "cache" / "model"
+    cache_dir.mkdir(parents=True)
+    prebuilt = user_path / "mlc" / "dist" / "prebuilt"
+    (prebuilt / "linked-model").symlink_to(cache_dir, target_is_directory=True)
+    (prebuilt / "lib").mkdir()
+    models = []
+    llm_mlc.register_models(models.append)
+    assert [(model.model_id, model.model_path) for model in models] == [
+        ("linked-model", str(prebuilt / "linked-model"))
+    ]
+
+
+def test_send_to_server_no_server(user_path):
+    assert send_to_server({"prompt": "hello"}) is None
+
+
+def test_send_to_server(user_path):
+    requests = []
+
+    def fake_server(server_sock):
+        conn, _ = server_sock.accept()
+        with conn, conn.makefile("rw", encoding="utf-8") as fp:
+            requests.append(json.loads(fp.readline()))
+            fp.write('{"delta": "Hello"}\n{"delta": " world"}\n')
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as server_sock:
+        server_sock.bind(str(server_socket_path()))
+        server_sock.listen()
+        thread = threading.Thread(target=fake_server, args=(server_sock,))
+        thread.start()
+        deltas = send_to_server({"prompt": "hello"})
+        assert list(deltas) == ["Hello", " world"]
+        thread.join()
+    assert requests == [{"prompt": "hello"}]
+
+
+class FakeChatModule:
+    def __init__(self):
+        self.calls = []
+
+    def reset_chat(self, chat_config=None):
+        self.calls.append(("reset_chat", chat_config))
+
+    def generate_iter(self, prompt):
+        self.calls.append(("generate", prompt))
+        yield "Reply "
+        yield "to {}".format(prompt)
+
+
+@pytest.fixture
+def fake_mlc_chat(monkeypatch):
+    monkeypatch.setattr(
+        llm_mlc,
+        "_mlc_chat",
+        (types.SimpleNamespace(ConvConfig=dict, ChatConfig=dict), None),
+    )
+
+
+def test_generate_continues_conversation_without_reset(fake_mlc_chat):
+    model = MlcModel(model_id="test", model_path="/tmp/test")
+    chat_mod = model.chat_mod = FakeChatModule()
+    options = MlcModel.Options()
+    assert list(model.generate("one", None, [], options, True)) == [
+        "Reply ",
+        "to one",
+    ]
+    history = [("USER", "one"), ("ASSISTANT", "Reply to one")]
+    assert "".join(model.generate("two", None, history, options, True)) == (
+        "Reply to two"
+    )
+    # A new conversation needs a reset
+    assert "".join(model.generate("three", None, [], options, True)) == (
+        "Reply to three"
+    )
+    assert chat_mod.calls == [
+        ("reset_chat", {"max_gen_len": 512, "conv_config": {}}),
+        ("generate", "one"),
+        ("generate", "two"),
+        # Same config as the first prompt, so that does not need rebuilding
+        ("reset_chat", None),
+        ("generate", "three"),
+    ]
+
+
+def test_conversation_messages_only_processes_new_responses():
+    text_calls = []
+
+    def make_response(prompt, system, text):
+        def get_text():
+            text_calls.append(text)
+            return text
+
+        return types.SimpleNamespace(
+            prompt=types.SimpleNamespace(prompt=prompt, system=system),
+            text=get_text,
+        )
+
+    conversation = types.SimpleNamespace(
+        responses=[make_response("one", "Be brief", "Reply one")]
+    )
+    assert conversation_messages(conversation) == (
+        [("USER", "one"), ("ASSISTANT", "Reply one")],
+        "Be brief",
+    )
+    conversation.responses.append(make_response("two", None, "Reply two"))
+    assert conversation_messages(conversation) == (
+        [
+            ("USER", "one"),
+            ("ASSISTANT", "Reply one"),
+            ("USER", "two"),
+            ("ASSISTANT", "Reply two"),
+        ],
+        "Be brief",
+    )
+    assert text_calls == ["Reply one", "Reply two"]
+
+
+def test_load_mlc_chat_not_installed(monkeypatch):
+    monkeypatch.setattr(llm_mlc, "_mlc_chat", None)
+    monkeypatch.setitem(sys.modules, "mlc_chat", None)
+    with pytest.raises(click.ClickException) as ex:
+        llm_mlc.load_mlc_chat()
+    assert llm_mlc._mlc_chat is False
+    assert ex.value.message == llm_mlc.MLC_INSTALL
+
+
+def send_to_handler(server, request):
+    client_sock, server_sock = socket.socketpair()
+    with client_sock:
+        client_sock.sendall((json.dumps(request) + "\n").encode("utf-8"))
+        with server_sock:
+            llm_mlc.ServeHandler(server_sock, None, server)
+        with client_sock.makefile("r", encoding="utf-8") as fp:
+            return [json.loads(line) for line in fp]
+
+
+def test_serve_handler(fake_mlc_chat, monkeypatch):
+    chat_mod = FakeChatModule()
+    monkeypatch.setattr(MlcModel, "load_chat_mod", lambda self: chat_mod)
+    server = types.SimpleNamespace(models={})
+    request = {
+        "model_path": "/tmp/prebuilt/test-model",
+        "prompt": "one",
+        "system": "Be brief",
+        "messages": [],
+        "options": {"temperature": 0.5, "max_gen_len": 100},
+        "stream": True,
+    }
+    assert send_to_handler(server, request) == [
+        {"delta": "Reply "},
+        {"delta": "to one"},
+    ]
+    # The model is created on demand and kept for later requests
+    assert list(server.models) == ["/tmp/prebuilt/test-model"]
+    assert server.models["/tmp/prebuilt/test-model"].model_id == "test-model"
+    assert chat_mod.calls == [
+        (
+            "reset_chat",
+            {
+                "max_gen_len": 100,
+                "conv_config": {"system": "Be brief"},
+                "temperature": 0.5,
+            },
+        ),
+        ("generate", "one"),
+    ]
+
+
+def test_serve_handler_error(fake_mlc_chat, monkeypatch):
+    def load_chat_mod(self):
+        raise RuntimeError("Model failed to load")
+
+    monkeypatch.setattr(MlcModel, "load_chat_mod", load_chat_mod)
+    server = types.SimpleNamespace(models={})
+    request = {
+        "model_path": "/tmp/prebuilt/test-model",
+        "prompt": "one",
+        "system": None,
+        "messages": [],
+        "options": {},
+        "stream": False,
+    }
+    assert send_to_handler(server, request) == [{"error": "Model failed to load"}]
+
+
+def test_serve_requires_unix_sockets(user_path, monkeypatch):
+    monkeypatch.delattr(socket, "AF_UNIX")
+    runner = CliRunner()
+    result = runner.invoke(cli, ["mlc", "serve"])
+    assert result.exit_code == 1
+    assert "Unix domain sockets" in result.output